@@ -24,20 +24,33 @@ We also provide some handy utility functions:
 
     * has_root():      check whether current process has root privileges
     * can_get_root():  check whether current process may be able to get root
+    * invalidate_root_cache():  recheck the cached results of the functions above
 """
 
 import sys
-import functools
-import pickle
 import logging
-
-logger = logging.getLogger("runas")
+import functools
+from .base import dump_pickle, send_pickle, recv_pickle, out_of_band
 
 if sys.platform == "win32":
     from . import win32 as sudo
 else:
     from . import posix as sudo
 
+logger = logging.getLogger("runas")
+
+_MSG_READY = b"READY"
+
+
+@functools.lru_cache(maxsize=None)
+def _control_message(msg):
+    """Return the serialized control message.
+
+    Control messages never change, so they are serialized only once.  This
+    happens on first use, importing runas does not need pickle.
+    """
+    return bytes(dump_pickle(msg)[0])
+
 
 def spawn_sudo(proxy, user, password, domain=""):
     return sudo.spawn_sudo(proxy, user, password, domain)
@@ -47,6 +60,10 @@ def has_root():
     return sudo.has_root()
 
 
+def invalidate_root_cache():
+    return sudo.invalidate_root_cache()
+
+
 def can_get_root():
     return sudo.can_get_root()
 
@@ -60,6 +77,10 @@ class SudoProxy:
 
     This class creates a copy of an object whose methods can be executed
     with root privileges.
+
+    The names of the proxy's own attributes (target, pipe, proc, closed,
+    start, close, terminate, run and batch) and names starting with an
+    underscore are not forwarded to the target.
     """
 
     def __init__(self, target):
@@ -69,6 +90,11 @@ class SudoProxy:
         self.closed = False
         self.pipe = None
 
+    def __reduce__(self):
+        #  Only the target is sent to the helper, process, pipe and cached
+        #  method wrappers are meaningless there.
+        return (self.__class__, (self.target,))
+
     def start(self, user, password):
         (self.proc, self.pipe) = spawn_sudo(self, user, password)
         if self.proc.poll() is not None:
@@ -82,12 +108,12 @@ class SudoProxy:
         except EOFError:
             logger.debug("##eof")
             msg = b""
-        if msg != b"READY":
+        if msg != _MSG_READY:
             self.close()
             raise RuntimeError("failed to spawn helper app")
 
     def close(self):
-        self.pipe.write(pickle.dumps("CLOSE"))
+        self.pipe.write(_control_message("CLOSE"))
         self.pipe.read()
         self.closed = True
 
@@ -100,45 +126,120 @@ class SudoProxy:
 
     def run(self, pipe):
         self.target.sudo_proxy = self
-        pipe.write(b"READY")
+        pipe.write(_MSG_READY)
         try:
             #  Process incoming commands in a loop.
             while True:
                 try:
-                    call = pickle.loads(pipe.read())
+                    call = recv_pickle(pipe)
                     if call == "CLOSE":
-                        pipe.write(pickle.dumps("CLOSING"))
+                        pipe.write(_control_message("CLOSING"))
                         break
+                    elif isinstance(call, list):
+                        #  A batch: stop at the first failing call.
+                        replies = []
+                        for methname, args in call:
+                            replies.append(self._execute(methname, args))
+                            if not replies[-1][0]:
+                                break
+                        send_pickle(pipe, replies)
                     else:
-                        methname, args = call
-                        try:
-                            method = getattr(self.target, methname)
-                            res = method(*args)
-                        except Exception as e:
-                            pipe.write(pickle.dumps((False, e)))
-                        else:
-                            pipe.write(pickle.dumps((True, res)))
+                        send_pickle(pipe, self._execute(*call))
                 except EOFError:
                     break
         finally:
             pipe.close()
 
+    def _execute(self, methname, args):
+        try:
+            method = getattr(self.target, methname)
+            res = method(*args)
+        except Exception as e:
+            return (False, e)
+        return (True, out_of_band(res))
+
+    def batch(self):
+        """Return a SudoBatch that sends its calls in a single message."""
+        return SudoBatch(self)
+
     def __getattr__(self, attr):
         if attr.startswith("_"):
             raise AttributeError(attr)
 
-        target = self.__dict__["target"]
-        method = getattr(target, attr)
+        method = getattr(self.__dict__["target"], attr)
+        methname = method.__name__
         pipe = self.__dict__["pipe"]
+        write = pipe.write
 
-        @functools.wraps(method)
         def wrapper(*args):
-            call = (method.__name__, args)
-            pipe.write(pickle.dumps(call))
-            (success, result) = pickle.loads(pipe.read())
+            data, buffers = dump_pickle((methname, tuple(map(out_of_band, args))))
+            write(data)
+            for buf in buffers:
+                write(buf)
+            (success, result) = recv_pickle(pipe)
             if not success:
                 raise result
             return result
 
+        #  Only the attributes that matter for introspection are copied,
+        #  functools.wraps does noticeably more work.
+        wrapper.__name__ = methname
+        wrapper.__qualname__ = method.__qualname__
+        wrapper.__doc__ = method.__doc__
         setattr(self, attr, wrapper)
         return wrapper
+
+
+class SudoBatch:
+    """Queue of proxy method calls sent to the helper in one round trip.
+
+    Example:
+
+        with sapp.batch() as batch:
+            batch.install_file("a")
+            batch.install_file("b")
+        batch.results
+        -->   [result_a, result_b]
+
+    The calls are executed in order when the with block is left.  Execution
+    stops at the first call that raises and its exception is re-raised.
+
+    results is the only public attribute, every other name that does not
+    start with an underscore queues a call of the target method.
+    """
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._calls = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._flush()
+
+    def _flush(self):
+        """Execute the queued calls and append their results to results."""
+        if not self._calls:
+            return
+        calls, self._calls = self._calls, []
+        pipe = self._proxy.pipe
+        send_pickle(pipe, calls)
+        for success, result in recv_pickle(pipe):
+            if not success:
+                raise result
+            self.results.append(result)
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+
+        methname = getattr(self.__dict__["_proxy"].target, attr).__name__
+
+        def queue(*args):
+            self._calls.append((methname, tuple(map(out_of_band, args))))
+
+        queue.__name__ = methname
+        return queue
@@ -4,25 +4,156 @@
 base functionality for runas
 """
 
+import os
 import sys
-import base64
 import struct
-import pickle
+import weakref
+import functools
 import logging
 
+#  pickle, zlib and base64 are imported where they are used, so importing
+#  runas does not load them until the first message is sent.
+
 logger = logging.getLogger("runas")
 
+#  Little-endian uint32 used for all size headers on the wire.
+_HDR = struct.Struct("<I")
+_NO_BUFFERS = _HDR.pack(0)
+
+#  Pickles larger than this are compressed by b64pickle.
+COMPRESS_THRESHOLD = 4096
+
+#  bytes and bytearray objects of at least this size are sent in frames of
+#  their own instead of being copied into the pickle stream.
+OUT_OF_BAND_THRESHOLD = 65536
+
+
+@functools.lru_cache(maxsize=None)
+def _base64_codec():
+    """Return the b64encode and b64decode functions to use."""
+    try:
+        #  SIMD accelerated base64, used when installed.
+        from pybase64 import b64encode, b64decode
+    except ImportError:
+        import binascii
+
+        def b64encode(data):
+            return binascii.b2a_base64(data, newline=False)
+
+        b64decode = binascii.a2b_base64
+    return b64encode, b64decode
+
 
 def b64pickle(obj):
-    """Serialize object to a base64-string."""
-    return base64.b64encode(pickle.dumps(obj, -1)).decode("ascii")
+    """Serialize object to a base64-string, large pickles are compressed."""
+    import pickle
+    data = pickle.dumps(obj, -1)
+    if len(data) > COMPRESS_THRESHOLD:
+        import zlib
+        data = zlib.compress(data)
+    return _base64_codec()[0](data).decode("ascii")
 
 
 def b64unpickle(data):
     """Deserialize object from a base64-string."""
-    if sys.version_info[0] > 2:
-        data = data.encode("ascii")
-    return pickle.loads(base64.b64decode(data))
+    import pickle
+    data = _base64_codec()[1](data)
+    #  Pickles start with the PROTO opcode, anything else is compressed.
+    if data[:1] != pickle.PROTO:
+        import zlib
+        data = zlib.decompress(data)
+    return pickle.loads(data)
+
+
+def _as_bytearray(buf):
+    #  Frames arrive as bytearray from StdPipe but as bytes from win32.
+    return buf if type(buf) is bytearray else bytearray(buf)
+
+
+class _OutOfBand:
+    """Pickles a bytes or bytearray object as out-of-band buffer."""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __reduce_ex__(self, protocol):
+        import pickle
+        obj = self.obj
+        factory = bytes if type(obj) is bytes else _as_bytearray
+        return (factory, (pickle.PickleBuffer(obj),))
+
+
+def out_of_band(obj):
+    """Mark obj to be sent in a frame of its own by send_pickle.
+
+    Only bytes and bytearray objects of at least OUT_OF_BAND_THRESHOLD
+    bytes are wrapped, other objects are returned unchanged.  The receiver
+    gets an object of the original type.
+    """
+    cls = type(obj)
+    if (cls is bytes or cls is bytearray) and len(obj) >= OUT_OF_BAND_THRESHOLD:
+        return _OutOfBand(obj)
+    return obj
+
+
+def dump_pickle(obj):
+    """Serialize object into the messages sent by send_pickle.
+
+    The object is pickled with protocol 5.  PickleBuffer objects, including
+    the ones made by out_of_band, are not copied into the pickle stream but
+    returned separately as buffers.  The first message holds the number of
+    these buffers followed by the pickle data.
+    """
+    import pickle
+    buffers = []
+    data = pickle.dumps(obj, 5, buffer_callback=buffers.append)
+    if not buffers:
+        #  The common case of small calls and results.
+        return _NO_BUFFERS + data, buffers
+    return _HDR.pack(len(buffers)) + data, [buf.raw() for buf in buffers]
+
+
+def helper_path(path=None):
+    """Return the sys.path to use in the helper process.
+
+    Entries of path (default sys.path) that do not exist and duplicates
+    are left out, the empty entry for the current directory is kept.
+    """
+    if path is None:
+        path = sys.path
+    return list(dict.fromkeys(p for p in path if not p or os.path.exists(p)))
+
+
+def send_pickle(pipe, obj):
+    """Serialize object and send it over the pipe."""
+    data, buffers = dump_pickle(obj)
+    pipe.write(data)
+    for buf in buffers:
+        pipe.write(buf)
+
+
+def recv_pickle(pipe):
+    """Receive an object sent by send_pickle and deserialize it."""
+    import pickle
+    data = pipe.read()
+    count = _HDR.unpack_from(data)[0]
+    if not count:
+        #  The common case of small calls and results.
+        return pickle.loads(memoryview(data)[_HDR.size:])
+    buffers = [pipe.read() for i in range(count)]
+    return pickle.loads(memoryview(data)[_HDR.size:], buffers=buffers)
+
+
+def encode_size(size):
+    """Encode a message size as a varint: 7 bits per byte, MSB continuation."""
+    out = bytearray()
+    while size >= 0x80:
+        out.append((size & 0x7F) | 0x80)
+        size >>= 7
+    out.append(size)
+    return bytes(out)
 
 
 def has_root():
@@ -39,46 +170,112 @@ def can_get_root():
     return True
 
 
+def _close_streams(*streams):
+    for stream in streams:
+        stream.close()
+
+
+#  Size of the receive buffer of StdPipe.
+RECV_BUFFER_SIZE = 65536
+
+
 class StdPipe:
     def __init__(self, read, write):
         self.read_stream = read
         self.write_stream = write
+        #  Own receive buffer: one read call usually fetches header and
+        #  payload of a message, often several messages at once.
+        self._rbuf = bytearray(RECV_BUFFER_SIZE)
+        self._rview = memoryview(self._rbuf)
+        self._rpos = self._rend = 0
+        self._readinto = getattr(read, "readinto1", read.readinto)
+        self._finalizer = weakref.finalize(self, _close_streams, read, write)
+
+    def _fill(self):
+        """Move unread bytes to the buffer start and append new data.
 
-    def _read(self, size):
-        return self.read_stream.read(size)
+        Returns False on EOF.
+        """
+        rest = self._rend - self._rpos
+        if rest:
+            #  At most a few header bytes, copied out since the ranges
+            #  may overlap.
+            self._rbuf[:rest] = bytes(self._rview[self._rpos:self._rend])
+        self._rpos = 0
+        count = self._readinto(self._rview[rest:]) or 0
+        self._rend = rest + count
+        return count > 0
 
     def _write(self, data):
         self.write_stream.write(data)
+
+    def _flush(self):
         self.write_stream.flush()
 
     def close(self):
-        self.read_stream.close()
-        self.write_stream.close()
+        self._finalizer()
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
+    def __exit__(self, *exc_info):
         self.close()
 
     def read(self):
         """Read the next string from the pipe.
 
-        The expected data format is:  4-byte size, data, signature
+        The expected data format is:  varint size, data
         """
-        sz = self._read(4)
-        if len(sz) < 4:
-            raise EOFError()
-        sz = struct.unpack("I", sz)[0]
-        data = self._read(sz)
-        if len(data) < sz:
-            raise EOFError()
+        while True:
+            #  Decode the varint header directly from the receive buffer.
+            buf = self._rbuf
+            pos = self._rpos
+            end = self._rend
+            size = shift = 0
+            while pos < end:
+                byte = buf[pos]
+                pos += 1
+                size |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+                if shift > 28:
+                    raise RuntimeError("invalid message size")
+            else:
+                #  The header is incomplete.
+                if not self._fill():
+                    raise EOFError()
+                continue
+            break
+
+        if pos + size <= end:
+            self._rpos = pos + size
+            return buf[pos:self._rpos]
+
+        #  The message is not buffered completely, the rest is read directly
+        #  from the stream.
+        data = bytearray(size)
+        have = end - pos
+        data[:have] = self._rview[pos:end]
+        self._rpos = self._rend = 0
+        view = memoryview(data)
+        while have < size:
+            count = self.read_stream.readinto(view[have:])
+            if not count:
+                raise EOFError()
+            have += count
         return data
 
     def write(self, data):
         """Write the given string to the pipe.
 
-        The expected data format is:  4-byte size, data, signature
+        The expected data format is:  varint size, data
         """
-        self._write(struct.pack("I", len(data)))
+        #  Both parts are collected by the buffered stream and
+        #  leave the process with a single flush.
+        self._write(encode_size(len(data)))
         self._write(data)
+        self._flush()
 
 
 def spawn_sudo(proxy):
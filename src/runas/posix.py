@@ -4,16 +4,32 @@ posix specific functionality
 """
 import os
 import sys
-import subprocess
+import functools
 import logging
 from . import base
 
 logger = logging.getLogger("runas")
 
+#  Minimal kernel buffer size of the stdio channel to the helper.
+SOCKET_BUFFER_SIZE = 65536
+
+
+_HAS_ROOT = os.geteuid() == 0
+
 
 def has_root():
-    """Check whether the use current has root access."""
-    return os.geteuid() == 0
+    """Check whether the use current has root access.
+
+    The result is determined once, call invalidate_root_cache() after
+    changing the effective user id.
+    """
+    return _HAS_ROOT
+
+
+def invalidate_root_cache():
+    """Recompute the result of has_root()."""
+    global _HAS_ROOT
+    _HAS_ROOT = os.geteuid() == 0
 
 
 def can_get_root():
@@ -25,21 +41,40 @@ def can_get_root():
     return True
 
 
-def find_exe(name, *args):
-    path = os.environ.get("PATH", "/bin:/usr/bin").split(":")
+@functools.lru_cache(maxsize=32)
+def _which(name, path):
+    import shutil
     if getattr(sys, "frozen", False):
-        path.append(os.path.dirname(sys.executable))
-    for dir in path:
-        exe = os.path.join(dir, name)
-        if os.path.exists(exe):
-            return [exe] + list(args)
-    return None
+        path = os.pathsep.join([path, os.path.dirname(sys.executable)])
+    return shutil.which(name, path=path)
+
+
+def find_exe(name, *args):
+    """Return the command line list for executable name, None if not found.
+
+    Lookups are cached per $PATH value.
+    """
+    exe = _which(name, os.environ.get("PATH", "/bin:/usr/bin"))
+    if exe is None:
+        return None
+    return [exe] + list(args)
+
+
+def _raise_buffer_size(sock):
+    import socket
+    for opt in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        if sock.getsockopt(socket.SOL_SOCKET, opt) < SOCKET_BUFFER_SIZE:
+            sock.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER_SIZE)
 
 
 def spawn_sudo(proxy, user, password, domain):
     """Spawn the sudo slave process, returning proc and a pipe to message it."""
+    #  Only needed when spawning, which keeps "import runas" cheap.
+    import socket
+    import subprocess
+
     exe = [sys.executable, "-c", "import runas; runas.run_proxy_startup()"]
-    args = ["--runas-spawn-sudo", base.b64pickle(sys.path), base.b64pickle(proxy)]
+    args = ["--runas-spawn-sudo"]
     # Look for a variety of sudo-like programs
     sudo = find_exe("sudo")
     if sudo is None:
@@ -55,24 +90,53 @@ def spawn_sudo(proxy, user, password, domain):
     exe = sudo + exe + args
     # Pass the pipe in environment vars, they seem to be harder to snoop.
 
-    # Spawn the subprocess
-    pipe = subprocess.PIPE
-    kwds = dict(stdin=pipe, stdout=pipe, stderr=pipe, close_fds=True, text=False)
-    # kwds = dict(stdin=pipe, stdout=pipe, close_fds=True, text=False)
-    logger.debug("start subprocess %r", exe)
-    proc = subprocess.Popen(exe, **kwds)
-    proc.stdin.write(password.encode("utf8")+b"\n")
-    proc.stdin.flush()
-
-    result = proc.stderr.read(1)
-    proc.stderr.close()
-    if result != b"@":
-        proc.stdin.close()
-        proc.stdout.close()
+    # sys.path and the proxy are serialized before anything is spawned, so an
+    # object that cannot be pickled fails without asking for credentials.
+    payloads = [base.dump_pickle(base.helper_path()), base.dump_pickle(proxy)]
+
+    # Spawn the subprocess.  close_fds keeps inheritable descriptors of the
+    # host application away from the setuid sudo binary.
+    # The helper's stdin and stdout are both connected to one end of a
+    # socketpair, which gives a single duplex channel with tunable buffers.
+    master, slave = socket.socketpair()
+    try:
+        _raise_buffer_size(master)
+        _raise_buffer_size(slave)
+        kwds = dict(stdin=slave, stdout=slave, stderr=subprocess.PIPE,
+                    close_fds=True, text=False)
+        logger.debug("start subprocess %r", exe)
+        proc = subprocess.Popen(exe, **kwds)
+    except BaseException:
+        master.close()
+        raise
+    finally:
+        slave.close()
+    read_stream = master.makefile("rb")
+    write_stream = master.makefile("wb")
+    master.close()
+    try:
+        write_stream.write(password.encode("utf8")+b"\n")
+        write_stream.flush()
+
+        result = proc.stderr.read(1)
+        proc.stderr.close()
+        if result != b"@":
+            raise RuntimeError("wrong credentials")
+
+        # sudo closes every inherited fd except stdio, so sys.path and the
+        # proxy are sent over stdin once the credentials have been accepted.
+        pipe = base.StdPipe(read_stream, write_stream)
+        for data, buffers in payloads:
+            pipe.write(data)
+            for buf in buffers:
+                pipe.write(buf)
+    except BaseException:
+        read_stream.close()
+        write_stream.close()
         proc.kill()
-        raise RuntimeError("wrong credentials")
-
-    return proc, base.StdPipe(proc.stdout, proc.stdin)
+        proc.wait()
+        raise
+    return proc, pipe
 
 
 def run_proxy_startup():
@@ -80,8 +144,10 @@ def run_proxy_startup():
     sys.stderr.write("@")
     sys.stderr.flush()
     if len(sys.argv) > 1 and sys.argv[1] == "--runas-spawn-sudo":
-        sys.path = base.b64unpickle(sys.argv[2])
-        proxy = base.b64unpickle(sys.argv[3])
-        proxy.run(base.StdPipe(os.fdopen(sys.stdin.fileno(), "rb"),
-                               os.fdopen(sys.stdout.fileno(), "wb")))
+        #  Nothing has been read from stdin yet, so StdPipe can read the
+        #  raw stream directly with its own receive buffer.
+        with base.StdPipe(sys.stdin.buffer.raw, sys.stdout.buffer) as pipe:
+            sys.path = base.recv_pickle(pipe)
+            proxy = base.recv_pickle(pipe)
+            proxy.run(pipe)
         sys.exit(0)
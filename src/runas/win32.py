@@ -9,20 +9,25 @@ launch a process with administrative rights on Windows Vista and above.
 
 import ctypes
 import ctypes.wintypes
+import functools
 import hmac
 import os
+import re
+import secrets
 import subprocess
-import struct
 import sys
-import uuid
+import weakref
 from . import base
 
 
 byref = ctypes.byref
 sizeof = ctypes.sizeof
-kernel32 = ctypes.windll.kernel32
-shell32 = ctypes.windll.shell32
-advapi32 = ctypes.windll.advapi32
+#  The DLLs are loaded by _init_prototypes() on first use, which keeps
+#  importing this module cheap and possible on other platforms.
+kernel32 = shell32 = advapi32 = None
+ShellExecuteEx = OpenProcessToken = CreateWellKnownSid = None
+CheckTokenMembership = GetTokenInformation = None
+_initialized = False
 
 GENERIC_READ = -0x80000000
 GENERIC_WRITE = 0x40000000
@@ -38,11 +43,21 @@ ERROR_PRIVILEGE_NOT_HELD = 1314
 TokenLinkedToken = 19
 SEE_MASK_NOCLOSEPROCESS = 0x00000040
 SEE_MASK_NOASYNC = 0x00000100
+FILE_FLAG_OVERLAPPED = 0x40000000
+ERROR_MORE_DATA = 234
+ERROR_PIPE_CONNECTED = 535
+ERROR_IO_PENDING = 997
+PIPE_READMODE_MESSAGE = 2
+PIPE_TYPE_MESSAGE = 4
+PIPE_BUFFER_SIZE = 65536
+INFINITE = 0xFFFFFFFF
+WAIT_TIMEOUT = 0x102
+STILL_ACTIVE = 259
 
 
 def _errcheck_bool(value, func, args):
     if not value:
-        raise ctypes.WinError()
+        raise ctypes.WinError(ctypes.get_last_error())
     return args
 
 
@@ -66,135 +81,208 @@ class SHELLEXECUTEINFO(ctypes.Structure):
     )
 
 
-try:
-    ShellExecuteEx = shell32.ShellExecuteEx
-except AttributeError:
-    ShellExecuteEx = None
-else:
-    ShellExecuteEx.restype = ctypes.wintypes.BOOL
-    ShellExecuteEx.errcheck = _errcheck_bool
-    ShellExecuteEx.argtypes = (
-        ctypes.POINTER(SHELLEXECUTEINFO),
+class OVERLAPPED(ctypes.Structure):
+    _fields_ = (
+      ("Internal", ctypes.c_size_t),
+      ("InternalHigh", ctypes.c_size_t),
+      ("Offset", ctypes.wintypes.DWORD),
+      ("OffsetHigh", ctypes.wintypes.DWORD),
+      ("hEvent", ctypes.wintypes.HANDLE),
     )
 
-try:
-    OpenProcessToken = advapi32.OpenProcessToken
-except AttributeError:
-    pass
-else:
-    OpenProcessToken.restype = ctypes.wintypes.BOOL
-    OpenProcessToken.errcheck = _errcheck_bool
-    OpenProcessToken.argtypes = (
-        ctypes.wintypes.HANDLE,
-        ctypes.wintypes.DWORD,
-        ctypes.POINTER(ctypes.wintypes.HANDLE)
-    )
 
-try:
-    CreateWellKnownSid = advapi32.CreateWellKnownSid
-except AttributeError:
-    pass
-else:
-    CreateWellKnownSid.restype = ctypes.wintypes.BOOL
-    CreateWellKnownSid.errcheck = _errcheck_bool
-    CreateWellKnownSid.argtypes = (
-        ctypes.wintypes.DWORD,
-        ctypes.POINTER(ctypes.wintypes.DWORD),
-        ctypes.c_void_p,
-        ctypes.POINTER(ctypes.wintypes.DWORD)
-    )
+INVALID_HANDLE_VALUE = ctypes.wintypes.HANDLE(-1).value
+
+
+def _errcheck_handle(value, func, args):
+    if value is None or value == INVALID_HANDLE_VALUE:
+        raise ctypes.WinError(ctypes.get_last_error())
+    return value
+
+
+def _prototype(func, restype, argtypes, errcheck=None):
+    func.restype = restype
+    func.argtypes = argtypes
+    if errcheck is not None:
+        func.errcheck = errcheck
+
+
+_HANDLE = ctypes.wintypes.HANDLE
+_BOOL = ctypes.wintypes.BOOL
+_DWORD = ctypes.wintypes.DWORD
+_LPDWORD = ctypes.POINTER(_DWORD)
+_LPOVERLAPPED = ctypes.POINTER(OVERLAPPED)
+
+#  Functions that may be missing on old systems, they stay None then.
+#  All of them report failure through _errcheck_bool.
+_PROTOTYPES = (
+    ("shell32", "ShellExecuteEx", _BOOL, (ctypes.POINTER(SHELLEXECUTEINFO),)),
+    ("advapi32", "OpenProcessToken", _BOOL,
+     (_HANDLE, _DWORD, ctypes.POINTER(_HANDLE))),
+    ("advapi32", "CreateWellKnownSid", _BOOL,
+     (_DWORD, _LPDWORD, ctypes.c_void_p, _LPDWORD)),
+    ("advapi32", "CheckTokenMembership", _BOOL,
+     (_HANDLE, ctypes.c_void_p, ctypes.POINTER(_BOOL))),
+    ("advapi32", "GetTokenInformation", _BOOL,
+     (_HANDLE, _DWORD, ctypes.c_void_p, _DWORD, _LPDWORD)),
+)
+
+
+def _init_prototypes():
+    """Load the DLLs and declare the function prototypes once."""
+    global _initialized, kernel32, shell32, advapi32
+    if _initialized:
+        return
+    #  use_last_error keeps a private copy of the error code right after
+    #  each call, GetLastError() itself may be clobbered by the interpreter.
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    shell32 = ctypes.WinDLL("shell32", use_last_error=True)
+    advapi32 = ctypes.WinDLL("advapi32", use_last_error=True)
+
+    #  kernel32 always provides these.  Read, write and connect calls have no
+    #  errcheck, in overlapped mode a FALSE result may just mean pending.
+    _prototype(kernel32.GetCurrentProcess, _HANDLE, ())
+    _prototype(kernel32.CloseHandle, _BOOL, (_HANDLE,))
+    _prototype(kernel32.CreateEventA, _HANDLE,
+               (ctypes.c_void_p, _BOOL, _BOOL, ctypes.c_char_p), _errcheck_handle)
+    _prototype(kernel32.CreateNamedPipeA, _HANDLE,
+               (ctypes.c_char_p, _DWORD, _DWORD, _DWORD, _DWORD, _DWORD, _DWORD,
+                ctypes.c_void_p), _errcheck_handle)
+    _prototype(kernel32.CreateFileA, _HANDLE,
+               (ctypes.c_char_p, _DWORD, _DWORD, ctypes.c_void_p, _DWORD, _DWORD, _HANDLE),
+               _errcheck_handle)
+    _prototype(kernel32.SetNamedPipeHandleState, _BOOL,
+               (_HANDLE, _LPDWORD, _LPDWORD, _LPDWORD), _errcheck_bool)
+    _prototype(kernel32.ConnectNamedPipe, _BOOL, (_HANDLE, _LPOVERLAPPED))
+    _prototype(kernel32.ReadFile, _BOOL,
+               (_HANDLE, ctypes.c_void_p, _DWORD, _LPDWORD, _LPOVERLAPPED))
+    _prototype(kernel32.WriteFile, _BOOL,
+               (_HANDLE, ctypes.c_void_p, _DWORD, _LPDWORD, _LPOVERLAPPED))
+    _prototype(kernel32.GetOverlappedResult, _BOOL,
+               (_HANDLE, _LPOVERLAPPED, _LPDWORD, _BOOL))
+    _prototype(kernel32.CancelIoEx, _BOOL, (_HANDLE, _LPOVERLAPPED))
+    _prototype(kernel32.GetProcessId, _DWORD, (_HANDLE,))
+    _prototype(kernel32.GetExitCodeProcess, _BOOL, (_HANDLE, _LPDWORD), _errcheck_bool)
+    _prototype(kernel32.WaitForSingleObject, _DWORD, (_HANDLE, _DWORD))
+    _prototype(kernel32.TerminateProcess, _BOOL, (_HANDLE, ctypes.c_uint))
+
+    dlls = {"shell32": shell32, "advapi32": advapi32}
+    for dll, name, restype, argtypes in _PROTOTYPES:
+        func = getattr(dlls[dll], name, None)
+        if func is not None:
+            _prototype(func, restype, argtypes, _errcheck_bool)
+        globals()[name] = func
+
+    _initialized = True
+
+
+@functools.lru_cache(maxsize=None)
+def has_root():
+    """Check whether the user currently has root access.
 
-try:
-    CheckTokenMembership = advapi32.CheckTokenMembership
-except AttributeError:
-    pass
-else:
-    CheckTokenMembership.restype = ctypes.wintypes.BOOL
-    CheckTokenMembership.errcheck = _errcheck_bool
-    CheckTokenMembership.argtypes = (
-        ctypes.wintypes.HANDLE,
-        ctypes.c_void_p,
-        ctypes.POINTER(ctypes.wintypes.BOOL)
-    )
+    The token of a process does not change, so the result is cached.
+    """
+    _init_prototypes()
+    return bool(shell32.IsUserAnAdmin())
 
-try:
-    GetTokenInformation = advapi32.GetTokenInformation
-except AttributeError:
-    pass
-else:
-    GetTokenInformation.restype = ctypes.wintypes.BOOL
-    GetTokenInformation.errcheck = _errcheck_bool
-    GetTokenInformation.argtypes = (
-        ctypes.wintypes.HANDLE,
-        ctypes.wintypes.DWORD,
-        ctypes.c_void_p,
-        ctypes.wintypes.DWORD,
-        ctypes.POINTER(ctypes.wintypes.DWORD)
-    )
 
+def invalidate_root_cache():
+    """Recompute the results of has_root() and can_get_root()."""
+    has_root.cache_clear()
+    can_get_root.cache_clear()
+
+
+_ADMIN_SID_CACHE = None
 
-def has_root():
-    """Check whether the user currently has root access."""
-    return bool(shell32.IsUserAnAdmin())
 
+def _get_admin_sid():
+    """Return the well-known Administrators SID, created on first use."""
+    global _ADMIN_SID_CACHE
+    if _ADMIN_SID_CACHE is None:
+        sid = ctypes.create_string_buffer(SECURITY_MAX_SID_SIZE)
+        sz = ctypes.wintypes.DWORD(SECURITY_MAX_SID_SIZE)
+        CreateWellKnownSid(WinBuiltinAdministratorsSid, None, byref(sid), byref(sz))
+        _ADMIN_SID_CACHE = sid
+    return _ADMIN_SID_CACHE
 
+
+@functools.lru_cache(maxsize=None)
 def can_get_root():
     """Check whether the user may be able to get root access."""
     #  On Vista or higher, there's the whole UAC token-splitting thing.
     #  Many thanks for Junfeng Zhang for the workflow:
     #      http://blogs.msdn.com/junfeng/archive/2007/01/26/how-to-tell-if-the-current-user-is-in-administrators-group-programmatically.aspx
-    proc = kernel32.GetCurrentProcess()
-    #  Get the token for the current process.
+    _init_prototypes()
+    sid = _get_admin_sid()
+    #  Check whether the effective token has that SID directly, this
+    #  needs no handle to the process token.
+    has_admin = ctypes.wintypes.BOOL()
+    CheckTokenMembership(None, byref(sid), byref(has_admin))
+    if has_admin.value:
+        return True
+    #  Get the token for the current process.  GetCurrentProcess returns
+    #  a pseudo-handle that must not be closed.
+    token = ctypes.wintypes.HANDLE()
+    OpenProcessToken(kernel32.GetCurrentProcess(), TOKEN_QUERY, byref(token))
     try:
-        token = ctypes.wintypes.HANDLE()
-        OpenProcessToken(proc, TOKEN_QUERY, byref(token))
+        #  Get the linked token.  Failure may mean no linked token.
+        lToken = ctypes.wintypes.HANDLE()
+        sz = ctypes.wintypes.DWORD()
+        try:
+            cls = TokenLinkedToken
+            GetTokenInformation(token, cls, byref(lToken), sizeof(lToken), byref(sz))
+        except WindowsError as e:
+            if e.winerror == ERROR_NO_SUCH_LOGON_SESSION:
+                return False
+            elif e.winerror == ERROR_PRIVILEGE_NOT_HELD:
+                return False
+            else:
+                raise
+        #  Check if the linked token has the admin SID
         try:
-            #  Get the administrators SID.
-            sid = ctypes.create_string_buffer(SECURITY_MAX_SID_SIZE)
-            sz = ctypes.wintypes.DWORD(SECURITY_MAX_SID_SIZE)
-            target_sid = WinBuiltinAdministratorsSid
-            CreateWellKnownSid(target_sid, None, byref(sid), byref(sz))
-            #  Check whether the token has that SID directly.
-            has_admin = ctypes.wintypes.BOOL()
-            CheckTokenMembership(None, byref(sid), byref(has_admin))
-            if has_admin.value:
-                return True
-            #  Get the linked token.  Failure may mean no linked token.
-            lToken = ctypes.wintypes.HANDLE()
-            try:
-                cls = TokenLinkedToken
-                GetTokenInformation(token, cls, byref(lToken), sizeof(lToken), byref(sz))
-            except WindowsError as e:
-                if e.winerror == ERROR_NO_SUCH_LOGON_SESSION:
-                    return False
-                elif e.winerror == ERROR_PRIVILEGE_NOT_HELD:
-                    return False
-                else:
-                    raise
-            #  Check if the linked token has the admin SID
-            try:
-                CheckTokenMembership(lToken, byref(sid), byref(has_admin))
-                return bool(has_admin.value)
-            finally:
-                kernel32.CloseHandle(lToken)
+            CheckTokenMembership(lToken, byref(sid), byref(has_admin))
+            return bool(has_admin.value)
         finally:
-            kernel32.CloseHandle(token)
+            kernel32.CloseHandle(lToken)
     finally:
-        kernel32.CloseHandle(proc)
+        kernel32.CloseHandle(token)
 
 
-class FakePopen(subprocess.Popen):
-    """Popen-alike based on a raw process handle."""
+class FakePopen:
+    """Popen-alike based on a raw process handle.
+
+    Only the parts of the Popen interface used by SudoProxy are provided.
+    """
 
     def __init__(self, handle):
-        super().__init__(None)
         self._handle = handle
+        self._finalizer = weakref.finalize(self, kernel32.CloseHandle, handle)
+        self.pid = kernel32.GetProcessId(handle)
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            code = ctypes.wintypes.DWORD()
+            kernel32.GetExitCodeProcess(self._handle, byref(code))
+            if code.value != STILL_ACTIVE:
+                self.returncode = code.value
+        return self.returncode
+
+    def wait(self, timeout=None):
+        ms = INFINITE if timeout is None else int(timeout * 1000)
+        if kernel32.WaitForSingleObject(self._handle, ms) == WAIT_TIMEOUT:
+            raise subprocess.TimeoutExpired(self.pid, timeout)
+        return self.poll()
 
     def terminate(self):
         kernel32.TerminateProcess(self._handle, -1)
 
-    def _execute_child(self, *args, **kwds):
-        pass
+    kill = terminate
+
+
+def _close_handles(*handles):
+    for handle in handles:
+        kernel32.CloseHandle(handle)
 
 
 class SecureStringPipe:
@@ -224,51 +312,125 @@ class SecureStringPipe:
     the new master process.  Not sure what can be done about this, but at the
     very worst this will allow the attacker to call into the esky API with
     root privs; it *shouldn't* be sufficient to crack root on the machine...
+
+    Both ends use overlapped I/O, so a blocked read, write or connect can be
+    aborted from another thread with cancel().  The pipe is in message mode,
+    every string with its signature is one pipe message.
     """
 
     def __init__(self, token=None, pipename=None):
+        _init_prototypes()
         if token is None:
             token = os.urandom(16)
         self.token = token
         self.connected = False
+        #  Bound once, these are used for every message.
+        self._ReadFile = kernel32.ReadFile
+        self._WriteFile = kernel32.WriteFile
+        self._GetOverlappedResult = kernel32.GetOverlappedResult
+        #  Receive buffer reused by all reads, grown on demand.
+        self._rbuf_size = 8192
+        self._rbuf = (ctypes.c_char * self._rbuf_size)()
 
         if pipename is None:
-            self.pipename = r"\\.\pipe\runas-" + uuid.uuid4().hex
+            self.pipename = r"\\.\pipe\runas-" + secrets.token_hex(16)
             self.pipename = self.pipename.encode('utf8')
-            self.pipe = kernel32.CreateNamedPipeA(self.pipename, 0x03, 0x00, 1, 8192, 8192, 0, None)
+            self._set_handle(kernel32.CreateNamedPipeA(
+                self.pipename, 0x03 | FILE_FLAG_OVERLAPPED,
+                PIPE_TYPE_MESSAGE | PIPE_READMODE_MESSAGE, 1,
+                PIPE_BUFFER_SIZE, PIPE_BUFFER_SIZE, 0, None))
         else:
             self.pipename = pipename
             self.pipe = None
 
-    def __del__(self):
+    def __reduce__(self):
+        #  The handle is process local, the peer reopens the pipe by name.
+        return (self.__class__, (self.token, self.pipename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
         self.close()
 
+    def _set_handle(self, handle):
+        self.pipe = handle
+        self._ov_read = OVERLAPPED()
+        self._ov_read.hEvent = kernel32.CreateEventA(None, False, False, None)
+        self._ov_write = OVERLAPPED()
+        self._ov_write.hEvent = kernel32.CreateEventA(None, False, False, None)
+        self._finalizer = weakref.finalize(
+            self, _close_handles, handle, self._ov_read.hEvent, self._ov_write.hEvent)
+        #  Per direction result counters and references, so a read and a
+        #  write can be in flight from different threads.
+        self._rcount = ctypes.wintypes.DWORD()
+        self._wcount = ctypes.wintypes.DWORD()
+        self._rrefs = (byref(self._ov_read), byref(self._rcount))
+        self._wrefs = (byref(self._ov_write), byref(self._wcount))
+
+    def _complete(self, ok, refs, count):
+        """Wait for an overlapped operation.
+
+        Returns the transferred bytes and the error code, which is 0 on
+        success and ERROR_MORE_DATA for a partially read message.
+        """
+        if not ok:
+            error = ctypes.get_last_error()
+            if error not in (ERROR_IO_PENDING, ERROR_MORE_DATA):
+                return 0, error
+        if not self._GetOverlappedResult(self.pipe, refs[0], refs[1], True):
+            return count.value, ctypes.get_last_error()
+        return count.value, 0
+
+    def cancel(self):
+        """Abort all pending I/O operations on the pipe."""
+        if self.pipe is not None:
+            kernel32.CancelIoEx(self.pipe, None)
+
     def connect(self):
         return SecureStringPipe(self.token, self.pipename)
 
-    def _read(self, size):
-        data = ctypes.create_string_buffer(size)
-        szread = ctypes.c_int()
-        kernel32.ReadFile(self.pipe, data, size, byref(szread), None)
-        return data.raw[:szread.value]
+    def _read(self):
+        """Read the next pipe message, an empty result means EOF."""
+        data = b""
+        refs = self._rrefs
+        while True:
+            ok = self._ReadFile(self.pipe, self._rbuf, self._rbuf_size, None, refs[0])
+            count, error = self._complete(ok, refs, self._rcount)
+            data += ctypes.string_at(self._rbuf, count)
+            if error != ERROR_MORE_DATA:
+                return data
+            #  The message did not fit, read the rest into a larger buffer.
+            self._rbuf_size *= 2
+            self._rbuf = (ctypes.c_char * self._rbuf_size)()
 
     def _write(self, data):
-        szwritten = ctypes.c_int()
-        kernel32.WriteFile(self.pipe, data, len(data), byref(szwritten), None)
+        refs = self._wrefs
+        ok = self._WriteFile(self.pipe, data, len(data), None, refs[0])
+        error = self._complete(ok, refs, self._wcount)[1]
+        if error:
+            raise ctypes.WinError(error)
 
     def close(self):
         if self.pipe is not None:
-            kernel32.CloseHandle(self.pipe)
+            self._finalizer()
             self.pipe = None
         self.connected = False
 
     def _open(self):
         if self.pipe is None:
-            self.pipe = kernel32.CreateFileA(
+            self._set_handle(kernel32.CreateFileA(
                 self.pipename, GENERIC_RDWR, 0, None, OPEN_EXISTING,
-                SECURITY_SQOS_PRESENT | SECURITY_IDENTIFICATION, None)
+                SECURITY_SQOS_PRESENT | SECURITY_IDENTIFICATION | FILE_FLAG_OVERLAPPED,
+                None))
+            mode = ctypes.wintypes.DWORD(PIPE_READMODE_MESSAGE)
+            kernel32.SetNamedPipeHandleState(self.pipe, byref(mode), None, None)
         else:
-            kernel32.ConnectNamedPipe(self.pipe, None)
+            ok = kernel32.ConnectNamedPipe(self.pipe, self._rrefs[0])
+            if ok or ctypes.get_last_error() != ERROR_PIPE_CONNECTED:
+                error = self._complete(ok, self._rrefs, self._rcount)[1]
+                if error:
+                    raise ctypes.WinError(error)
 
     def check_connection(self):
         if not self.connected:
@@ -280,17 +442,15 @@ class SecureStringPipe:
     def read(self):
         """Read the next string from the pipe.
 
-        The expected data format is:  4-byte size, data, signature
+        The expected data format is one pipe message:  data, signature
         """
         self.check_connection()
-        sz = self._read(4)
-        if len(sz) < 4:
+        data = self._read()
+        sz = len(data) - self._read_hmac.digest_size
+        if sz < 0:
             raise EOFError
-        sz = struct.unpack("I", sz)[0]
-        data = self._read(sz)
-        if len(data) < sz:
-            raise EOFError
-        sig = self._read(self._read_hmac.digest_size)
+        sig = data[sz:]
+        data = data[:sz]
         self._read_hmac.update(data)
         if sig != self._read_hmac.digest():
             self.close()
@@ -300,13 +460,26 @@ class SecureStringPipe:
     def write(self, data):
         """Write the given string to the pipe.
 
-        The expected data format is:  4-byte size, data, signature
+        The expected data format is one pipe message:  data, signature
         """
         self.check_connection()
-        self._write(struct.pack("I", len(data)))
-        self._write(data)
         self._write_hmac.update(data)
-        self._write(self._write_hmac.digest())
+        self._write(b"".join((data, self._write_hmac.digest())))
+
+
+#  Arguments that need no quoting, like the base64 payloads.
+_SAFE_ARG = re.compile(r"[A-Za-z0-9+/=_\-.\\:]+\Z")
+
+
+def _quote_arg(arg):
+    if _SAFE_ARG.match(arg):
+        return arg
+    return subprocess.list2cmdline([arg])
+
+
+@functools.lru_cache(maxsize=4)
+def _encoded_path(path):
+    return base.b64pickle(base.helper_path(path))
 
 
 def spawn_sudo(proxy, user, password, domain):
@@ -315,12 +488,13 @@ def spawn_sudo(proxy, user, password, domain):
     This function spawns the proxy app with administrator privileges, using
     ShellExecuteEx and the undocumented-but-widely-recommended "runas" verb.
     """
+    _init_prototypes()
     pipe = SecureStringPipe()
     c_pipe = pipe.connect()
 
     exe = [sys.executable, "-c", "import runas; runas.run_proxy_startup()"]
-    args = ["--runas-spawn-sudo", base.b64pickle(sys.path), base.b64pickle(proxy),
-            base.b64pickle(c_pipe)]
+    args = ["--runas-spawn-sudo", _encoded_path(tuple(sys.path)),
+            base.b64pickle(proxy), base.b64pickle(c_pipe)]
     exe = exe + args
     execinfo = SHELLEXECUTEINFO()
     execinfo.cbSize = sizeof(execinfo)
@@ -328,7 +502,7 @@ def spawn_sudo(proxy, user, password, domain):
     execinfo.hwnd = None
     execinfo.lpVerb = b"runas"
     execinfo.lpFile = exe[0].encode('cp1252')
-    execinfo.lpParameters = subprocess.list2cmdline(exe[1:]).encode('cp1252')
+    execinfo.lpParameters = " ".join(map(_quote_arg, exe[1:])).encode('cp1252')
     execinfo.lpDirectory = None
     execinfo.nShow = 0
     ShellExecuteEx(byref(execinfo))
@@ -340,6 +514,6 @@ def run_proxy_startup():
     if len(sys.argv) > 1 and sys.argv[1] == "--runas-spawn-sudo":
         sys.path = base.b64unpickle(sys.argv[2])
         proxy = base.b64unpickle(sys.argv[3])
-        pipe = base.b64unpickle(sys.argv[4])
-        proxy.run(pipe)
+        with base.b64unpickle(sys.argv[4]) as pipe:
+            proxy.run(pipe)
         sys.exit(0)
@@ -1,11 +1,17 @@
 """test autoupdate methods"""
 import sys
 import os
+import collections
+import pickle
+import threading
 import unittest
+from unittest import mock
 import logging
 from pathlib import Path
 from commands import SudoCommands
 from runas import SudoProxy, can_get_root
+from runas import base
+from runas.base import StdPipe, send_pickle, recv_pickle, dump_pickle, out_of_band
 
 DIR = str(Path(__file__).resolve().parent)
 
@@ -21,6 +27,140 @@ class TestSudo(unittest.TestCase):
         self.assertTrue(proxy.is_root())
         proxy.terminate()
 
+    def test_batch(self):
+        proxy = SudoProxy(SudoCommands())
+        user = "Administrator" if sys.platform == "win32" else "root"
+        proxy.start(user, os.environ["PASS"])
+        with proxy.batch() as batch:
+            batch.is_root()
+            batch.is_root()
+        self.assertEqual(batch.results, [True, True])
+        proxy.terminate()
+
+
+class MessagePipe:
+    """In-memory pipe whose read() returns bytes, like SecureStringPipe."""
+
+    def __init__(self):
+        self.messages = collections.deque()
+
+    def write(self, data):
+        self.messages.append(bytes(data))
+
+    def read(self):
+        return self.messages.popleft()
+
+
+class TestPipe(unittest.TestCase):
+    def setUp(self):
+        rfd, wfd = os.pipe()
+        self.pipe = StdPipe(os.fdopen(rfd, "rb"), os.fdopen(wfd, "wb"))
+
+    def tearDown(self):
+        self.pipe.close()
+
+    def test_sizes(self):
+        #  Messages larger than the OS pipe buffer and RECV_BUFFER_SIZE need
+        #  a concurrent writer.
+        sizes = (0, 1, 127, 128, 16383, 16384, 20000, 65536, 65537, 300000)
+
+        def write():
+            for size in sizes:
+                self.pipe.write(bytes([size % 256]) * size)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            for size in sizes:
+                self.assertEqual(self.pipe.read(), bytes([size % 256]) * size)
+        finally:
+            writer.join()
+
+    def test_fragmented(self):
+        #  Headers and payloads split over several reads.
+        rfd, wfd = os.pipe()
+        stream = os.fdopen(rfd, "rb", buffering=0)
+        pipe = StdPipe(stream, os.fdopen(wfd, "wb"))
+        self.addCleanup(pipe.close)
+        pipe._readinto = lambda view: stream.readinto(view[:3])
+        sizes = (0, 200, 20000, 5)
+        for size in sizes:
+            pipe.write(bytes([size % 256]) * size)
+        for size in sizes:
+            self.assertEqual(pipe.read(), bytes([size % 256]) * size)
+
+    def test_pickle(self):
+        obj = ("method", (b"data", bytearray(b"buffer"), 1))
+        send_pickle(self.pipe, obj)
+        self.assertEqual(recv_pickle(self.pipe), obj)
+
+    @mock.patch.object(base, "OUT_OF_BAND_THRESHOLD", 1024)
+    def test_pickle_buffers(self):
+        #  SecureStringPipe.read returns bytes instead of bytearray.
+        for pipe in (self.pipe, MessagePipe()):
+            data = bytes(range(256)) * 4
+            obj = ("method", (out_of_band(data), out_of_band(bytearray(data)),
+                              pickle.PickleBuffer(b"buffer"), out_of_band(b"small")))
+            self.assertEqual(len(dump_pickle(obj)[1]), 3)
+            send_pickle(pipe, obj)
+            methname, args = recv_pickle(pipe)
+            self.assertEqual(methname, "method")
+            self.assertEqual(type(args[0]), bytes)
+            self.assertEqual(type(args[1]), bytearray)
+            self.assertEqual(args[:2], (data, bytearray(data)))
+            self.assertEqual(bytes(args[2]), b"buffer")
+            self.assertEqual(args[3], b"small")
+
+
+class Recorder:
+    def __init__(self):
+        self.log = []
+
+    def add(self, a, b):
+        self.log.append(("add", a, b))
+        return a + b
+
+    def fail(self):
+        self.log.append(("fail",))
+        raise ValueError("fail")
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        down_r, down_w = os.pipe()
+        up_r, up_w = os.pipe()
+        server = StdPipe(os.fdopen(down_r, "rb"), os.fdopen(up_w, "wb"))
+        self.client = StdPipe(os.fdopen(up_r, "rb"), os.fdopen(down_w, "wb"))
+        self.target = Recorder()
+        self.server = threading.Thread(target=SudoProxy(self.target).run, args=(server,))
+        self.server.start()
+        self.proxy = SudoProxy(self.target)
+        self.proxy.pipe = self.client
+        self.assertEqual(self.client.read(), b"READY")
+
+    def tearDown(self):
+        self.proxy.close()
+        self.server.join()
+        self.client.close()
+
+    def test_results(self):
+        with self.proxy.batch() as batch:
+            batch.add(1, 2)
+            batch.add("a", "b")
+            batch.add(3, 4)
+        self.assertEqual(batch.results, [3, "ab", 7])
+        self.assertEqual(len(self.target.log), 3)
+
+    def test_failure(self):
+        with self.assertRaises(ValueError):
+            with self.proxy.batch() as batch:
+                batch.add(1, 2)
+                batch.fail()
+                batch.add(3, 4)
+        self.assertEqual(batch.results, [3])
+        self.assertEqual(self.target.log, [("add", 1, 2), ("fail",)])
+        #  The proxy is still usable after the failed batch.
+        self.assertEqual(self.proxy.add(5, 6), 11)
 
 if __name__ == "__main__":
     log_format = (